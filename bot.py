@@ -1,21 +1,69 @@
 # bot.py
 import os
-import json
+import time
 import asyncio
+import contextlib
 import logging
-from typing import Dict, List, Any
+import re
+from collections import deque
+from functools import lru_cache
+from typing import AsyncIterator, Dict, Iterator, List, Any, Optional, Set, Tuple
 
+import brotli
 import discord
+import orjson
+import tiktoken
 from discord.ext import commands
 
 # g4f async client
 from g4f.client import AsyncClient
+from g4f.errors import RateLimitError, ResponseStatusError
+from g4f.errors import TimeoutError as G4FTimeoutError
 import g4f
 
+# optional: semantic reply cache (pip install sentence-transformers)
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
 # ---------- Config & constants ----------
-CONFIG_FILE = "g4f_bot_config.json"
+COMMAND_PREFIX = "!"
+CONFIG_FILE = "g4f_bot_config.json.br"  # brotli-compressed JSON
+LEGACY_CONFIG_FILE = "g4f_bot_config.json"  # plain JSON, read once for migration
+BROTLI_QUALITY = 4
+CONV_DIR = "conversations"  # one compressed shard per channel
 CONTEXT_LIMIT = 12  # number of message pairs to keep (system + recent)
-AI_TIMEOUT = 60  # seconds to wait for AI reply before timing out
+CONTEXT_TOKEN_BUDGET = 3000  # max prompt tokens sent per request
+SUMMARY_EVERY = 4  # summarize evicted history once this many exchanges have piled up
+SUMMARY_MODEL = "gpt-4o-mini"  # cheap model used for the rolling summary
+SUMMARY_PREFIX = "Prior conversation summary: "
+OVERFLOW_LIMIT = SUMMARY_EVERY * 2 * 4  # unsummarized messages kept if summaries keep failing
+SYSTEM_PROMPT = "You are a helpful, concise assistant in a Discord channel. Answer politely."
+AI_TIMEOUT = 60  # seconds to wait for (each piece of) the AI reply before timing out
+AI_REPLY_DEADLINE = AI_TIMEOUT * 3  # seconds a whole streamed reply may take
+AI_MAX_ATTEMPTS = 3  # tries per message before giving up
+AI_RETRY_BACKOFF = 2.0  # seconds before the first retry; doubles each time
+DEFAULT_MAX_TOKENS = 1024  # cap on reply length; owner can change it with !setmaxtokens
+SUMMARY_MAX_TOKENS = 300
+REPLY_CHUNK_SIZE = 1900  # stay under Discord's 2000 character message limit
+CHANNEL_QUEUE_SIZE = 5  # messages waiting per channel before new ones are turned away
+MAX_INFLIGHT_MESSAGES = 16  # channel workers answering at once (see INGRESS_SEM)
+CONFIG_FLUSH_INTERVAL = 1.0  # seconds between background config writes
+# "prefix=requests_per_min/tokens_per_min" per model family, first matching
+# prefix wins ("" matches anything); override with G4F_RATE_LIMITS, "off" disables
+DEFAULT_RATE_LIMITS = "gpt-=60/200000,claude-=30/100000,=60/200000"
+EMBED_MODEL = "all-MiniLM-L6-v2"  # sentence-transformers model for the reply cache
+SEMANTIC_CACHE_THRESHOLD = 0.93  # cosine similarity needed to reuse a cached reply
+SEMANTIC_CACHE_SIZE = 200  # cached question/answer pairs per channel
+SEMANTIC_CACHE_MIN_CHARS = 12  # shorter messages ("yes", "why?") depend on context; never cached
+# words that tie a question to the conversation so far ("explain that", "give me an example")
+CONTEXT_WORDS = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|he|she|him|her|his|above|previous|earlier|"
+    r"again|more|another|example|elaborate|continue|same|also|else|why)\b",
+    re.IGNORECASE,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("g4f-discord-bot")
@@ -37,140 +85,675 @@ except Exception:
     raise RuntimeError("OWNER_ID must be an integer (Discord user id) in secrets.")
 
 # ---------- persistence ----------
+def _dump(obj: Any) -> bytes:
+    # compact UTF-8 JSON; indentation would only be compressed away again
+    return orjson.dumps(obj)
+
+def _decode(raw: bytes) -> Any:
+    try:
+        raw = brotli.decompress(raw)
+    except brotli.error:
+        pass  # not compressed (older plain-JSON file)
+    return orjson.loads(raw)
+
 def load_config() -> Dict[str, Any]:
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"bound_channel": None, "model": DEFAULT_MODEL, "conversations": {}}
+    for path in (CONFIG_FILE, LEGACY_CONFIG_FILE):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return _decode(f.read())
+    return {"bound_channel": None, "model": DEFAULT_MODEL, "max_tokens": DEFAULT_MAX_TOKENS}
+
+def _atomic_write(path: str, data: bytes):
+    # write a temp file and swap it in, so a crash never leaves truncated JSON
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _compress_and_write(path: str, data: bytes):
+    _atomic_write(path, brotli.compress(data, quality=BROTLI_QUALITY))
 
 def save_config(cfg: Dict[str, Any]):
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=2)
+    _compress_and_write(CONFIG_FILE, _dump(cfg))
+
+async def save_config_async(cfg: Dict[str, Any]):
+    # serialize on the loop (a consistent snapshot), compress + write in a worker thread
+    data = _dump(cfg)
+    await asyncio.to_thread(_compress_and_write, CONFIG_FILE, data)
+
+# Conversations are sharded per channel so an AI turn only rewrites its own
+# history, never the config or other channels. Histories live in CONV_CACHE
+# once loaded; turns just append in memory and mark the shard dirty.
+#
+# In memory a conversation is {"system": msg, "summary": str, "overflow": deque,
+# "recent": deque}; appending to the bounded "recent" deque moves the oldest
+# message to "overflow" instead of re-trimming a list. Overflow is folded into
+# "summary" every SUMMARY_EVERY exchanges. On disk it is the plain message
+# list [system, summary?, *overflow, *recent].
+Conversation = Dict[str, Any]
+
+CONV_CACHE: Dict[str, Conversation] = {}
+DIRTY_CONVS: Set[str] = set()
+
+def new_conv(system: Optional[Dict[str, str]] = None) -> Conversation:
+    return {
+        "system": system or {"role": "system", "content": SYSTEM_PROMPT},
+        "summary": None,
+        "summarizing": False,
+        # not a maxlen deque: summarize_overflow relies on nothing vanishing
+        # mid-summary; OVERFLOW_LIMIT is enforced after each exchange instead
+        "overflow": deque(),
+        "recent": deque(maxlen=CONTEXT_LIMIT * 2),  # each exchange has user + assistant
+        # semantic reply cache: (question, answer) pairs for stand-alone
+        # questions and their embeddings, which are computed lazily on the
+        # first lookup
+        "cache": deque(maxlen=SEMANTIC_CACHE_SIZE),
+        "cache_vecs": None,
+    }
+
+def conv_from_list(history: List[Dict[str, str]]) -> Conversation:
+    system, summary, messages = None, None, []
+    for m in history:
+        if m.get("role") != "system":
+            messages.append(m)
+        elif m.get("content", "").startswith(SUMMARY_PREFIX):
+            summary = m["content"][len(SUMMARY_PREFIX):]
+        elif system is None:
+            system = m
+    conv = new_conv(system)
+    conv["summary"] = summary
+    split = max(0, len(messages) - CONTEXT_LIMIT * 2)
+    conv["overflow"].extend(messages[:split])
+    conv["recent"].extend(messages[split:])
+    return conv
+
+def conv_to_list(conv: Conversation) -> List[Dict[str, str]]:
+    summary = [{"role": "system", "content": SUMMARY_PREFIX + conv["summary"]}] if conv["summary"] else []
+    return [conv["system"], *summary, *conv["overflow"], *conv["recent"]]
+
+def conv_append(conv: Conversation, message: Dict[str, str]):
+    recent = conv["recent"]
+    if len(recent) == recent.maxlen:
+        conv["overflow"].append(recent[0])
+    recent.append(message)
+
+def conv_prompt(conv: Conversation) -> List[Dict[str, str]]:
+    # messages sent to the model: system (merged with the summary) + everything
+    # not yet summarized; trim_messages_to_budget keeps the payload bounded
+    system = conv["system"]
+    if conv["summary"]:
+        system = {**system, "content": f"{system['content']}\n\n{SUMMARY_PREFIX}{conv['summary']}"}
+    return [system, *conv["overflow"], *conv["recent"]]
+
+def conv_path(key: str) -> str:
+    return os.path.join(CONV_DIR, f"{key}.json.br")
+
+def reply_cache_path(key: str) -> str:
+    return os.path.join(CONV_DIR, f"{key}.cache.json.br")
+
+def load_conv(key: str) -> Conversation:
+    conv = new_conv()
+    path = conv_path(key)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            conv = conv_from_list(_decode(f.read()))
+    path = reply_cache_path(key)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            conv["cache"].extend((q, a) for q, a, *_ in _decode(f.read()) if _cacheable(q))
+    return conv
+
+def get_conv(key: str) -> Conversation:
+    conv = CONV_CACHE.get(key)
+    if conv is None:
+        conv = CONV_CACHE[key] = load_conv(key)
+    return conv
+
+def _write_shard(path: str, data: Optional[bytes]):
+    # data=None means the content was cleared: drop the shard
+    if data is None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    os.makedirs(CONV_DIR, exist_ok=True)
+    _compress_and_write(path, data)
+
+def _write_conv(key: str, payload: Tuple[Optional[bytes], Optional[bytes]]):
+    history, reply_cache = payload
+    _write_shard(conv_path(key), history)
+    _write_shard(reply_cache_path(key), reply_cache)
+
+def _conv_payload(key: str) -> Tuple[Optional[bytes], Optional[bytes]]:
+    conv = CONV_CACHE.get(key)
+    if not conv:
+        return None, None
+    history = _dump(conv_to_list(conv)) if conv["recent"] else None
+    reply_cache = _dump(list(conv["cache"])) if conv["cache"] else None
+    return history, reply_cache
+
+def mark_conv_dirty(key: str):
+    DIRTY_CONVS.add(key)
+
+def delete_conv(key: str):
+    # only the history: cached FAQ answers don't depend on it
+    old, CONV_CACHE[key] = CONV_CACHE.get(key), new_conv()
+    if old is not None:
+        CONV_CACHE[key]["cache"] = old["cache"]
+        CONV_CACHE[key]["cache_vecs"] = old["cache_vecs"]
+    DIRTY_CONVS.add(key)
 
 config = load_config()
 
-# Ensure conversations key
-if "conversations" not in config:
-    config["conversations"] = {}
+# Move conversations out of older single-file configs into their own shards
+if "conversations" in config:
+    for key, conv in config.pop("conversations").items():
+        _write_shard(conv_path(key), _dump(conv))
+    save_config(config)
+
+# Bound channel id kept as an int so the per-message check is a plain compare
+BOUND_CHANNEL_INT: Optional[int] = int(config["bound_channel"]) if config.get("bound_channel") else None
+
+# Writes are coalesced: mutations only flag the config (or a conversation
+# shard) as dirty and the background writer persists it at most once per
+# CONFIG_FLUSH_INTERVAL.
+_config_dirty = False
+_config_writer_task: Optional[asyncio.Task] = None
+
+def mark_config_dirty():
+    global _config_dirty
+    _config_dirty = True
+
+def flush_config():
+    global _config_dirty
+    if _config_dirty:
+        _config_dirty = False
+        save_config(config)
+    while DIRTY_CONVS:
+        key = DIRTY_CONVS.pop()
+        _write_conv(key, _conv_payload(key))
+
+async def _config_writer_loop():
+    global _config_dirty
+    while True:
+        await asyncio.sleep(CONFIG_FLUSH_INTERVAL)
+        if _config_dirty:
+            _config_dirty = False
+            try:
+                await save_config_async(config)
+            except Exception:
+                logger.exception("Failed to write config")
+                _config_dirty = True
+        for key in list(DIRTY_CONVS):
+            DIRTY_CONVS.discard(key)
+            data = _conv_payload(key)  # serialized on the loop: a consistent snapshot
+            try:
+                await asyncio.to_thread(_write_conv, key, data)
+            except Exception:
+                logger.exception("Failed to write conversation %s", key)
+                DIRTY_CONVS.add(key)
 
 # ---------- bot setup ----------
 intents = discord.Intents.default()
 intents.message_content = True  # required to read message text
 intents.messages = True
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents, help_command=None)
 
 # g4f client (async)
 g4f_client = AsyncClient()
 
-# Per-channel locks to prevent concurrent queries
-channel_locks: Dict[int, asyncio.Lock] = {}
+# Caps in-flight g4f requests across all channels
+API_SEM = asyncio.Semaphore(int(os.environ.get("G4F_MAX_CONC", "5")))
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    if spec.strip().lower() == "off":
+        return {}
+    profiles = {}
+    for item in spec.split(","):
+        prefix, _, limits = item.strip().rpartition("=")
+        rpm, tpm = limits.split("/")
+        profiles[prefix] = (int(rpm), int(tpm))
+    return profiles
+
+try:
+    RATE_LIMIT_PROFILES = parse_rate_limits(os.environ.get("G4F_RATE_LIMITS", DEFAULT_RATE_LIMITS))
+except ValueError:
+    raise RuntimeError('G4F_RATE_LIMITS must look like "gpt-=60/200000,=60/200000" or "off".')
+
+class RateLimiter:
+    """Sliding-window RPM/TPM limiter with AIMD limits.
+
+    The effective limits are halved whenever the provider answers 429 and
+    grow back additively on each success, up to the profile's ceiling.
+    A limiter without a profile (rpm=0) admits everything.
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.unlimited = rpm <= 0 or tpm <= 0
+        self.max_rpm, self.max_tpm = rpm, tpm
+        self.rpm, self.tpm = float(rpm), float(tpm)
+        self._events: deque = deque()  # (timestamp, tokens) inside the window
+        self._tokens = 0
+        self._largest = 0  # biggest request seen, so back-off never starves it
+        self._lock = asyncio.Lock()  # waiters are served in arrival order
+
+    def _prune(self, now: float):
+        while self._events and self._events[0][0] <= now - self.WINDOW:
+            self._tokens -= self._events.popleft()[1]
+
+    async def acquire(self, est_tokens: int):
+        if self.unlimited:
+            return
+        self._largest = max(self._largest, min(est_tokens, self.max_tpm))
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._prune(now)
+                # an empty window always admits, so one oversized request can't stall forever
+                if not self._events or (
+                    len(self._events) < int(self.rpm) and self._tokens + est_tokens <= self.tpm
+                ):
+                    self._events.append((now, est_tokens))
+                    self._tokens += est_tokens
+                    return
+                await asyncio.sleep(self._events[0][0] + self.WINDOW - now)
+
+    def on_success(self):
+        if self.unlimited:
+            return
+        self.rpm = min(self.max_rpm, self.rpm + 1)
+        self.tpm = min(self.max_tpm, self.tpm + self.max_tpm / self.max_rpm)
+
+    def on_rate_limited(self):
+        if self.unlimited:
+            return
+        self.rpm = max(1.0, self.rpm / 2)
+        # the floor still fits a couple of typical requests per window
+        floor = max(self.max_tpm / self.max_rpm, min(self.max_tpm, 2 * self._largest))
+        self.tpm = max(floor, self.tpm / 2)
+
+rate_limiters: Dict[str, RateLimiter] = {}
+
+def rate_limiter_for(model: str) -> RateLimiter:
+    limiter = rate_limiters.get(model)
+    if limiter is None:
+        prefix = next((p for p in RATE_LIMIT_PROFILES if model.startswith(p)), None)
+        limits = RATE_LIMIT_PROFILES[prefix] if prefix is not None else ()
+        limiter = rate_limiters[model] = RateLimiter(*limits)
+    return limiter
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected
+_background_tasks: Set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # ---------- helpers ----------
-def is_owner_check(ctx: commands.Context):
+async def is_owner_check(ctx: commands.Context) -> bool:
     return ctx.author.id == OWNER_ID_INT
 
-def ensure_channel_lock(channel_id: int) -> asyncio.Lock:
-    if channel_id not in channel_locks:
-        channel_locks[channel_id] = asyncio.Lock()
-    return channel_locks[channel_id]
-
 def conv_key(channel_id: int) -> str:
     return str(channel_id)
 
-def trim_history(history: List[Dict[str,str]]) -> List[Dict[str,str]]:
-    # keep system + last CONTEXT_LIMIT user/assistant messages
-    system = [m for m in history if m.get("role") == "system"]
-    non_sys = [m for m in history if m.get("role") != "system"]
-    trimmed = non_sys[-(CONTEXT_LIMIT * 2):]  # each exchange has user + assistant approx
-    return system + trimmed
+def _cut_point(text: str, start: int, limit: int) -> int:
+    # prefer ending a chunk at a line break, then a sentence, then a word
+    end = start + limit
+    if end >= len(text):
+        return len(text)
+    for sep in ("\n", ". ", " "):
+        cut = text.rfind(sep, start, end)
+        if cut > start:
+            return cut + len(sep)
+    return end
+
+FENCE = re.compile(r"^[ \t]*```(\S*)", re.MULTILINE)
+FENCE_CLOSE = "\n```"
+
+def take_chunk(text: str, limit: int = REPLY_CHUNK_SIZE) -> Tuple[str, str]:
+    """Split off the first Discord-sized chunk of text; returns (chunk, rest).
+
+    A chunk that ends inside a ``` code block gets the fence closed, and the
+    rest starts by reopening it with the same language tag, so both
+    messages render as code.
+    """
+    if len(text) <= limit:
+        return text, ""
+    # never cut inside a leading fence line (e.g. one reopened by us)
+    head = text.find("\n") + 1 if text.lstrip(" \t").startswith("```") else 0
+    cut = _cut_point(text, head, limit - head - len(FENCE_CLOSE))
+    chunk, rest = text[:cut], text[cut:]
+    lang = None  # language of the currently open block, None when outside one
+    for fence in FENCE.finditer(chunk):
+        lang = fence.group(1) if lang is None else None
+    if lang is not None:
+        chunk = chunk.rstrip("\n") + FENCE_CLOSE
+        rest = f"```{lang}\n{rest}"
+    return chunk, rest
+
+def split_reply(text: str, limit: int = REPLY_CHUNK_SIZE) -> Iterator[str]:
+    while text:
+        chunk, text = take_chunk(text, limit)
+        if chunk.strip():  # Discord rejects whitespace-only messages
+            yield chunk
+
+# Loaded at startup, before the event loop runs: the first load on a fresh
+# host downloads the BPE file, which must not block the gateway heartbeat.
+_encoding = tiktoken.get_encoding("cl100k_base")
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    # cached: history messages are re-counted on every turn while they stay in context.
+    # encode_ordinary: user text like "<|endoftext|>" is plain text, not a special token
+    return len(_encoding.encode_ordinary(text))
+
+def count_message_tokens(messages: List[Dict[str,str]]) -> int:
+    return sum(count_tokens(m["content"]) for m in messages)
+
+def trim_messages_to_budget(history: List[Dict[str,str]], budget: int = CONTEXT_TOKEN_BUDGET) -> List[Dict[str,str]]:
+    # keep the system message (index 0) plus the newest messages that fit the budget
+    system, rest = history[0], history[1:]
+    remaining = budget - count_tokens(system["content"])
+    kept: List[Dict[str,str]] = []
+    for m in reversed(rest):
+        tokens = count_tokens(m["content"])
+        if tokens > remaining:
+            if not kept and remaining > 0:
+                # a single oversized newest message: send only what fits
+                content = _encoding.decode(_encoding.encode_ordinary(m["content"])[:remaining])
+                kept.append({**m, "content": content})
+            break
+        remaining -= tokens
+        kept.append(m)
+    kept.reverse()
+    return [system, *kept]
+
+@lru_cache(maxsize=1)
+def _embedder() -> "SentenceTransformer":
+    return SentenceTransformer(EMBED_MODEL)
+
+def _embed(texts: List[str]) -> "np.ndarray":
+    return _embedder().encode(texts, normalize_embeddings=True)
+
+def _cacheable(text: str) -> bool:
+    # Only questions that stand on their own are cached, so the same answer
+    # fits whenever they are asked; follow-ups depend on the conversation.
+    return (
+        SentenceTransformer is not None
+        and len(text) >= SEMANTIC_CACHE_MIN_CHARS
+        and not CONTEXT_WORDS.search(text)
+    )
+
+async def semantic_lookup(conv: Conversation, user_text: str) -> Tuple[Optional[str], Optional["np.ndarray"]]:
+    # returns (cached reply or None, embedding of user_text for semantic_store)
+    if not _cacheable(user_text):
+        return None, None
+    cache = conv["cache"]
+    if conv["cache_vecs"] is None and cache:
+        questions = [q for q, _ in cache]
+        conv["cache_vecs"] = await asyncio.to_thread(_embed, questions)
+    q = (await asyncio.to_thread(_embed, [user_text]))[0]
+    # the deque may have changed while embedding; only trust aligned vectors
+    vecs = conv["cache_vecs"]
+    if vecs is not None and len(vecs) == len(cache):
+        scores = vecs @ q
+        best = int(np.argmax(scores))
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return cache[best][1], q
+    return None, q
+
+def semantic_store(conv: Conversation, user_text: str, q: Optional["np.ndarray"], ai_text: str):
+    if q is None:
+        return
+    cache, vecs = conv["cache"], conv["cache_vecs"]
+    if vecs is None and not cache:
+        vecs = q[None, :]
+    elif vecs is not None and len(vecs) == len(cache):
+        if len(cache) == cache.maxlen:
+            vecs = vecs[1:]  # the deque is about to drop its oldest entry
+        vecs = np.vstack([vecs, q[None, :]])
+    else:
+        vecs = None  # re-embed on the next lookup
+    conv["cache_vecs"] = vecs
+    cache.append((user_text, ai_text))
+
+async def summarize_overflow(key: str, conv: Conversation):
+    batch = list(conv["overflow"])
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in batch)
+    prompt = "Summarize this Discord conversation in a few sentences. Keep names, facts and open questions."
+    if conv["summary"]:
+        prompt += f"\n\nSummary of what came before:\n{conv['summary']}"
+    prompt += f"\n\nConversation:\n{transcript}"
+    messages = [{"role":"user", "content": prompt}]
+    limiter = rate_limiter_for(SUMMARY_MODEL)
+    try:
+        await limiter.acquire(count_message_tokens(messages) + SUMMARY_MAX_TOKENS)
+        async with API_SEM:
+            response = await asyncio.wait_for(
+                g4f_client.chat.completions.create(
+                    model=SUMMARY_MODEL,
+                    messages=messages,
+                    web_search=False,
+                    max_tokens=SUMMARY_MAX_TOKENS
+                ),
+                timeout=AI_TIMEOUT
+            )
+        limiter.on_success()
+        conv["summary"] = response.choices[0].message.content.strip()
+        # drop only the summarized messages; newer ones may have arrived meanwhile
+        summarized = {id(m) for m in batch}
+        overflow = conv["overflow"]
+        while overflow and id(overflow[0]) in summarized:
+            overflow.popleft()
+        mark_conv_dirty(key)
+    except RateLimitError:
+        limiter.on_rate_limited()
+        logger.warning("Summarizing conversation %s was rate limited", key)
+    except Exception:
+        # keep the overflow; it is retried after the next exchange
+        logger.exception("Summarizing conversation %s failed", key)
+    finally:
+        conv["summarizing"] = False
+
+def is_transient(error: Exception) -> bool:
+    # worth retrying: timeouts, rate limits and provider-side (5xx) failures;
+    # anything else (unknown model, auth, bad request) fails the same way again
+    if isinstance(error, (asyncio.TimeoutError, G4FTimeoutError, RateLimitError)):
+        return True
+    if isinstance(error, ResponseStatusError):
+        # g4f only carries the status in the message: "Response 502: ..."
+        status = re.match(r"Response (\d{3})", str(error))
+        return status is not None and status.group(1).startswith("5")
+    return False
+
+async def _stream_text(stream) -> AsyncIterator[str]:
+    # AI_TIMEOUT bounds the wait for each streamed piece, not the whole reply
+    pieces = stream.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(pieces.__anext__(), timeout=AI_TIMEOUT)
+        except StopAsyncIteration:
+            return
+        text = chunk.choices[0].delta.content if chunk.choices else None
+        if text:
+            yield text
+
+async def _read_stream(model: str, messages: List[Dict[str,str]], max_tokens: int, pieces: asyncio.Queue):
+    # Runs as its own task holding an API_SEM slot (released by the caller's
+    # done callback), so the slot is never tied up by Discord sends.
+    # Puts each piece of text on `pieces`, then None when the stream ends.
+    stream = g4f_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        web_search=False,
+        max_tokens=max_tokens,
+        stream=True
+    )
+    async def pump():
+        async for text in _stream_text(stream):
+            pieces.put_nowait(text)
 
-async def ai_get_response(channel_id: int, user_text: str, model: str) -> str:
-    # conversation stored in config["conversations"][channel_id]
-    key = conv_key(channel_id)
-    conv = config["conversations"].get(key, [])
-    # If empty, start with system prompt
-    if not conv:
-        conv = [{"role":"system", "content":"You are a helpful, concise assistant in a Discord channel. Answer politely."}]
-    conv.append({"role":"user", "content": user_text})
-    # Trim to avoid huge payload
-    conv = trim_history(conv)
-    config["conversations"][key] = conv
-    save_config(config)
+    try:
+        # per-piece timeout inside _stream_text, overall deadline here
+        await asyncio.wait_for(pump(), timeout=AI_REPLY_DEADLINE)
+    finally:
+        pieces.put_nowait(None)
+        try:
+            await stream.aclose()
+        except Exception:
+            logger.debug("Closing the AI stream failed", exc_info=True)
 
+async def ai_stream_reply(channel_id: int, user_text: str, model: str) -> AsyncIterator[str]:
+    """Yield the reply as Discord-sized chunks while the model is still streaming it."""
+    # conversation stored in its own shard under CONV_DIR
+    key = conv_key(channel_id)
+    conv = get_conv(key)
+    cached, q = await semantic_lookup(conv, user_text)
+    if cached is not None:
+        conv_append(conv, {"role":"user", "content": user_text})
+        conv_append(conv, {"role":"assistant", "content": cached})
+        mark_conv_dirty(key)
+        for chunk in split_reply(cached):
+            yield chunk
+        return
+    # bounded deque evicts the oldest messages to overflow; the token budget trims the payload further
+    # persisted together with the reply below, not before the API call
+    conv_append(conv, {"role":"user", "content": user_text})
+
+    messages = trim_messages_to_budget(conv_prompt(conv))
+    max_tokens = config.get("max_tokens", DEFAULT_MAX_TOKENS)
+    limiter = rate_limiter_for(model)
+    est_tokens = count_message_tokens(messages) + max_tokens
+    ai_text, buf, error = "", "", None
+    done = False
     try:
-        # call g4f async client
-        response = await asyncio.wait_for(
-            g4f_client.chat.completions.create(
-                model=model,
-                messages=conv,
-                web_search=False
-            ),
-            timeout=AI_TIMEOUT
-        )
-        # Extract text
-        ai_text = response.choices[0].message.content
-        # add assistant message to history
-        conv.append({"role":"assistant", "content": ai_text})
-        config["conversations"][key] = trim_history(conv)
-        save_config(config)
-        return ai_text
-    except asyncio.TimeoutError:
-        return "⚠️ Sorry — the AI took too long to respond. Try again later."
-    except Exception as e:
-        logger.exception("AI request failed")
-        return f"⚠️ Error contacting AI: {e}"
+        for attempt in range(AI_MAX_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(AI_RETRY_BACKOFF * 2 ** (attempt - 1))
+            error, retry = None, True
+            try:
+                await limiter.acquire(est_tokens)
+                # call g4f async client; the reader task owns the API slot
+                await API_SEM.acquire()
+                pieces: asyncio.Queue = asyncio.Queue()
+                reader = asyncio.create_task(_read_stream(model, messages, max_tokens, pieces))
+                reader.add_done_callback(lambda _: API_SEM.release())
+                try:
+                    while (text := await pieces.get()) is not None:
+                        ai_text += text
+                        buf += text
+                        # send full chunks as soon as they are available
+                        while len(buf) > REPLY_CHUNK_SIZE:
+                            chunk, buf = take_chunk(buf)
+                            if chunk.strip():
+                                yield chunk
+                    await reader  # re-raises whatever ended the stream
+                finally:
+                    # the consumer stopped early (e.g. a failed send): drop the stream
+                    reader.cancel()
+                limiter.on_success()
+            except asyncio.TimeoutError:
+                logger.warning("AI request timed out (attempt %d/%d)", attempt + 1, AI_MAX_ATTEMPTS)
+                error = "⚠️ Sorry — the AI took too long to respond. Try again later."
+            except RateLimitError:
+                limiter.on_rate_limited()
+                logger.warning("AI request rate limited for model %s (attempt %d/%d)", model, attempt + 1, AI_MAX_ATTEMPTS)
+                error = "⚠️ The AI provider is rate limiting me right now. Try again in a minute."
+            except Exception as e:
+                logger.exception("AI request failed (attempt %d/%d)", attempt + 1, AI_MAX_ATTEMPTS)
+                error = f"⚠️ Error contacting AI: {e}"
+                retry = is_transient(e)
+            # once part of the reply has streamed in, a retry would start it over
+            if error is None or ai_text or not retry:
+                break
+
+        for chunk in split_reply(buf):
+            yield chunk
+        if error:
+            yield error
+        done = True
+    finally:
+        # also runs when the consumer closes us early (e.g. a failed send):
+        # the channel saw part of the reply, so keep it in the history
+        if ai_text:
+            conv_append(conv, {"role":"assistant", "content": ai_text})
+            if done and error is None:
+                semantic_store(conv, user_text, q, ai_text)
+            mark_conv_dirty(key)
+            overflow = conv["overflow"]
+            if not conv["summarizing"]:
+                # summaries keep failing: forget the oldest rather than grow forever
+                while len(overflow) > OVERFLOW_LIMIT:
+                    overflow.popleft()
+                if len(overflow) >= SUMMARY_EVERY * 2:
+                    conv["summarizing"] = True  # cleared by summarize_overflow
+                    spawn(summarize_overflow(key, conv))
 
 # ---------- Commands (owner only) ----------
 @bot.command(name="setupchannel")
+@commands.check(is_owner_check)
 async def setupchannel(ctx: commands.Context):
     """Owner only: bind this channel as the bot's listening/responding channel."""
-    if ctx.author.id != OWNER_ID_INT:
-        await ctx.reply("You are not authorized to use this command.", mention_author=False)
-        return
-    config["bound_channel"] = str(ctx.channel.id)
-    save_config(config)
+    global BOUND_CHANNEL_INT
+    config["bound_channel"] = BOUND_CHANNEL_INT = ctx.channel.id
+    mark_config_dirty()
     await ctx.reply(f"✅ This channel is now bound. I will respond to messages here.", mention_author=False)
 
 @bot.command(name="unsetchannel")
+@commands.check(is_owner_check)
 async def unsetchannel(ctx: commands.Context):
-    if ctx.author.id != OWNER_ID_INT:
-        await ctx.reply("You are not authorized to use this command.", mention_author=False)
-        return
-    config["bound_channel"] = None
-    save_config(config)
+    global BOUND_CHANNEL_INT
+    config["bound_channel"] = BOUND_CHANNEL_INT = None
+    mark_config_dirty()
     await ctx.reply("✅ Channel unbound. I will no longer listen to channel messages.", mention_author=False)
 
 @bot.command(name="setmodel")
+@commands.check(is_owner_check)
 async def setmodel(ctx: commands.Context, model: str):
-    if ctx.author.id != OWNER_ID_INT:
-        await ctx.reply("You are not authorized to use this command.", mention_author=False)
-        return
     config["model"] = model
-    save_config(config)
+    mark_config_dirty()
     await ctx.reply(f"✅ Model set to `{model}`.", mention_author=False)
 
+@bot.command(name="setmaxtokens")
+@commands.check(is_owner_check)
+async def setmaxtokens(ctx: commands.Context, max_tokens: int):
+    if max_tokens < 1:
+        await ctx.reply("Max tokens must be a positive number.", mention_author=False)
+        return
+    config["max_tokens"] = max_tokens
+    mark_config_dirty()
+    await ctx.reply(f"✅ Max reply tokens set to `{max_tokens}`.", mention_author=False)
+
 @bot.command(name="clearhistory")
+@commands.check(is_owner_check)
 async def clearhistory(ctx: commands.Context):
-    if ctx.author.id != OWNER_ID_INT:
-        await ctx.reply("You are not authorized to use this command.", mention_author=False)
-        return
     key = conv_key(ctx.channel.id)
-    config["conversations"].pop(key, None)
-    save_config(config)
+    delete_conv(key)
     await ctx.reply("✅ Conversation history cleared for this channel.", mention_author=False)
 
 @bot.command(name="status")
 async def status(ctx: commands.Context):
     bound = config.get("bound_channel")
     model = config.get("model", DEFAULT_MODEL)
+    max_tokens = config.get("max_tokens", DEFAULT_MAX_TOKENS)
     bound_text = f"<#{bound}>" if bound else "Not bound"
-    await ctx.reply(f"**Status**\nBound channel: {bound_text}\nModel: `{model}`", mention_author=False)
+    await ctx.reply(f"**Status**\nBound channel: {bound_text}\nModel: `{model}`\nMax reply tokens: `{max_tokens}`", mention_author=False)
 
 @bot.command(name="shutdown")
+@commands.check(is_owner_check)
 async def shutdown(ctx: commands.Context):
-    if ctx.author.id != OWNER_ID_INT:
-        await ctx.reply("You are not authorized to use this command.", mention_author=False)
-        return
     await ctx.reply("Shutting down... (owner requested)", mention_author=False)
     await bot.close()
 
@@ -178,72 +761,106 @@ async def shutdown(ctx: commands.Context):
 async def ping(ctx: commands.Context):
     await ctx.reply(f"Pong! latency: {round(bot.latency*1000)} ms", mention_author=False)
 
+@bot.event
+async def on_command_error(ctx: commands.Context, error: commands.CommandError):
+    if isinstance(error, commands.CheckFailure):
+        await ctx.reply("You are not authorized to use this command.", mention_author=False)
+        return
+    logger.error("Command %s failed", ctx.command, exc_info=error)
+
 # ---------- Message handling ----------
+# One queue + worker per active channel: messages are answered one at a time,
+# in the order they were sent. A worker exits once its queue drains.
+channel_queues: Dict[int, asyncio.Queue] = {}
+# Caps workers answering at the same time. With a single bound channel there
+# is only ever one worker, so this never limits anything today; it matters
+# only if the bot is taught to answer in several channels.
+INGRESS_SEM = asyncio.Semaphore(MAX_INFLIGHT_MESSAGES)
+
+def enqueue_message(message: discord.Message) -> bool:
+    channel_id = message.channel.id
+    queue = channel_queues.get(channel_id)
+    if queue is None:
+        queue = channel_queues[channel_id] = asyncio.Queue(maxsize=CHANNEL_QUEUE_SIZE)
+        spawn(_channel_worker(channel_id, queue))
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        return False
+    return True
+
+async def _channel_worker(channel_id: int, queue: asyncio.Queue):
+    while True:
+        try:
+            message = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            channel_queues.pop(channel_id, None)  # the next message starts a new worker
+            return
+        try:
+            await _dispatch(message)
+        except Exception:
+            logger.exception("Handling message %s failed", message.id)
+
+async def _dispatch(message: discord.Message):
+    async with INGRESS_SEM:
+        await _handle_message(message)
+
+async def _handle_message(message: discord.Message):
+    # no lock needed: the channel's single worker is the only caller
+    # show typing indicator
+    typing = message.channel.typing()
+    await typing.__aenter__()  # start typing
+    try:
+        model = config.get("model", DEFAULT_MODEL)
+        user_text = message.content.strip()
+        # safety: short-circuit empty messages/attachments-only
+        if not user_text:
+            await message.channel.send("I didn't see any text to respond to.", delete_after=6)
+            return
+        # Call AI and send the reply as it streams in (chunks respect Discord limits)
+        async with contextlib.aclosing(ai_stream_reply(message.channel.id, user_text, model)) as reply:
+            async for chunk in reply:
+                await message.channel.send(chunk)
+    finally:
+        await typing.__aexit__(None, None, None)
+
 @bot.event
 async def on_message(message: discord.Message):
-    # always process commands first
-    await bot.process_commands(message)
-
-    # ignore bots & DMs
-    if message.author.bot:
-        return
-    if message.guild is None:
-        # ignore DMs in this implementation
+    # ignore bots & DMs (commands included) in this implementation
+    if message.author.bot or message.guild is None:
         return
 
-    bound = config.get("bound_channel")
-    if not bound:
-        return  # not bound yet; do nothing
+    # only prefixed messages can be commands; skip the command parser for plain chat
+    if message.content.startswith(COMMAND_PREFIX):
+        await bot.process_commands(message)
 
-    try:
-        if str(message.channel.id) != str(bound):
-            return  # only respond in bound channel
-    except Exception:
+    # not bound yet, or not the bound channel: do nothing
+    if BOUND_CHANNEL_INT is None or message.channel.id != BOUND_CHANNEL_INT:
         return
 
     # Owner & admin commands are allowed via prefix; non-owners just chat
-    # Acquire lock for this channel
-    lock = ensure_channel_lock(message.channel.id)
-    if lock.locked():
-        # Inform user politely that bot is busy with prior request
+    # Queue the message; the channel's worker answers messages in order
+    if not enqueue_message(message):
         try:
-            await message.channel.send("⏳ I'm still processing a previous message — please wait a moment.", delete_after=6)
+            await message.channel.send("⏳ I'm still working through earlier messages — please try again in a moment.", delete_after=6)
         except Exception:
             pass
-        return
-
-    async with lock:
-        # show typing indicator
-        typing = message.channel.typing()
-        await typing.__aenter__()  # start typing
-        try:
-            model = config.get("model", DEFAULT_MODEL)
-            user_text = message.content.strip()
-            # safety: short-circuit empty messages/attachments-only
-            if not user_text:
-                await message.channel.send("I didn't see any text to respond to.", delete_after=6)
-                return
-            # Call AI
-            ai_reply = await ai_get_response(message.channel.id, user_text, model)
-            # send reply in thread-safe manner (respect Discord limits)
-            # If reply is long, split into chunks
-            MAX = 1900
-            chunks = [ai_reply[i:i+MAX] for i in range(0, len(ai_reply), MAX)]
-            reply_to = message.author
-            for chunk in chunks:
-                await message.channel.send(chunk)
-        finally:
-            await typing.__aexit__(None, None, None)
 
 # ---------- startup ----------
 @bot.event
 async def on_ready():
     logger.info(f"Logged in as {bot.user} (id: {bot.user.id})")
     logger.info("------")
+    global _config_writer_task
+    if _config_writer_task is None or _config_writer_task.done():
+        _config_writer_task = asyncio.create_task(_config_writer_loop())
 
 def main():
     save_config(config)  # ensure config file exists
-    bot.run(DISCORD_TOKEN)
+    try:
+        bot.run(DISCORD_TOKEN)
+    finally:
+        flush_config()  # persist anything the background writer hasn't yet
 
 if __name__ == "__main__":
     main()